@@ -32,6 +32,8 @@ class RemoteHandler(protocol.RemoteProtocolHandler):
 	_remoteSessionhasFocus: typing.Optional[bool] = None
 	_driver: Driver
 	_abstract__driver = True
+	#: Maps setting attributes to their decoded setting names.
+	_settingNameCache: typing.Dict[protocol.AttributeT, str]
 
 	def _get__driver(self) -> Driver:
 		raise NotImplementedError
@@ -68,6 +70,7 @@ class RemoteHandler(protocol.RemoteProtocolHandler):
 		pipeName: str,
 		isNamedPipeClient: bool = True,
 	):
+		self._settingNameCache = {}
 		self._isSecureDesktopHandler = not isNamedPipeClient
 		super().__init__()
 		self.initIo(ioThread, pipeName, isNamedPipeClient)
@@ -80,19 +83,20 @@ class RemoteHandler(protocol.RemoteProtocolHandler):
 	def _onConnected(self, connected: bool = True):
 		if self._isSecureDesktopHandler:
 			self._remoteSessionhasFocus = connected
+			self._hasFocusDirty = True
 		if connected:
 			self._handleDriverChanged(self._driver)
 
 	def event_gainFocus(self, _obj):
 		if self._isSecureDesktopHandler:
 			return
-		# Invalidate the property cache to ensure that hasFocus will be fetched again.
+		# Mark hasFocus dirty to ensure it will be fetched again.
 		# Normally, hasFocus should be cached since it is pretty expensive
 		# and should never try to fetch the time since input from the remote driver
-		# more than once per core cycle.
-		# However, if we don't clear the cache here, the braille handler won't be enabled correctly
+		# more than necessary.
+		# However, if we don't dirty it here, the braille handler won't be enabled correctly
 		# for the first focus outside the remote window.
-		self.invalidateCache()
+		self._hasFocusDirty = True
 		self._remoteSessionhasFocus = None
 
 	@protocol.attributeSender(protocol.GenericAttribute.SUPPORTED_SETTINGS)
@@ -113,23 +117,36 @@ class RemoteHandler(protocol.RemoteProtocolHandler):
 	@protocol.attributeReceiver(protocol.SETTING_ATTRIBUTE_PREFIX + b"*")
 	def _incoming_setting(self, _attribute: protocol.AttributeT, payLoad: bytes):
 		assert len(payLoad) > 0
-		return self._unpickle(payLoad)
+		return self._decodeSettingValue(payLoad)
+
+	def _getSettingName(self, attribute: protocol.AttributeT) -> str:
+		name = self._settingNameCache.get(attribute)
+		if name is None:
+			name = attribute[len(protocol.SETTING_ATTRIBUTE_PREFIX) :].decode("ASCII")
+			self._settingNameCache[attribute] = name
+		return name
 
 	@_incoming_setting.updateCallback
 	def _setIncomingSettingOnDriver(self, attribute: protocol.AttributeT, value: typing.Any):
 		if not configuration.getDriverSettingsManagement():
 			return
-		name = attribute[len(protocol.SETTING_ATTRIBUTE_PREFIX) :].decode("ASCII")
-		setattr(self._driver, name, value)
+		setattr(self._driver, self._getSettingName(attribute), value)
 
 	@protocol.attributeSender(protocol.SETTING_ATTRIBUTE_PREFIX + b"*")
 	def _outgoing_setting(self, attribute: protocol.AttributeT):
 		if not configuration.getDriverSettingsManagement():
-			return self._pickle(None)
-		name = attribute[len(protocol.SETTING_ATTRIBUTE_PREFIX) :].decode("ASCII")
-		return self._pickle(getattr(self._driver, name))
+			return self._encodeSettingValue(None)
+		return self._encodeSettingValue(getattr(self._driver, self._getSettingName(attribute)))
 
 	_remoteProcessHasFocus: bool
+	# hasFocus is cached manually with a dirty flag rather than through
+	# AutoPropertyObject, so focus events only flip a bool instead of
+	# invalidating the whole property cache. _remoteProcessHasFocus is only
+	# fetched while recomputing hasFocus, so it needs no caching of its own.
+	_cache__remoteProcessHasFocus = False
+	_cache_hasFocus = False
+	_hasFocusDirty: bool = True
+	_hasFocusCached: bool = False
 
 	def _get__remoteProcessHasFocus(self):
 		if self._isSecureDesktopHandler:
@@ -144,14 +161,20 @@ class RemoteHandler(protocol.RemoteProtocolHandler):
 	hasFocus: bool
 
 	def _get_hasFocus(self) -> bool:
-		remoteProcessHasFocus = self._remoteProcessHasFocus
-		if not remoteProcessHasFocus:
-			return remoteProcessHasFocus
+		if not self._hasFocusDirty:
+			return self._hasFocusCached
+		if not self._remoteProcessHasFocus:
+			self._hasFocusCached = False
+			self._hasFocusDirty = False
+			return False
 		if self._remoteSessionhasFocus is not None:
-			return self._remoteSessionhasFocus
+			self._hasFocusCached = self._remoteSessionhasFocus
+			self._hasFocusDirty = False
+			return self._hasFocusCached
 		log.debug("Requesting time since input from remote driver")
 		attribute = protocol.GenericAttribute.TIME_SINCE_INPUT
 		self.requestRemoteAttribute(attribute)
+		# Stay dirty until the remote driver answers.
 		return False
 
 	@protocol.attributeReceiver(protocol.GenericAttribute.TIME_SINCE_INPUT, defaultValue=False)
@@ -163,6 +186,7 @@ class RemoteHandler(protocol.RemoteProtocolHandler):
 	def _post_timeSinceInput(self, attribute: protocol.AttributeT, value: int):
 		assert attribute == protocol.GenericAttribute.TIME_SINCE_INPUT
 		self._remoteSessionhasFocus = value <= MAX_TIME_SINCE_INPUT_FOR_REMOTE_SESSION_FOCUS
+		self._hasFocusDirty = True
 		if self._remoteSessionhasFocus:
 			self._handleRemoteSessionGainFocus()
 
@@ -198,7 +198,7 @@ class RemoteDriver(protocol.RemoteProtocolHandler, driverHandler.Driver):
 	@protocol.attributeReceiver(protocol.SETTING_ATTRIBUTE_PREFIX + b"*")
 	def _incoming_setting(self, _attribute: protocol.AttributeT, payLoad: bytes):
 		assert len(payLoad) > 0
-		return self._unpickle(payLoad)
+		return self._decodeSettingValue(payLoad)
 
 	@protocol.attributeReceiver(b"available*s")
 	def _incoming_availableSettingValues(self, _attribute: protocol.AttributeT, payLoad: bytes):
@@ -82,7 +82,7 @@ class SettingsAccessorBase(AutoPropertyObject):
 		def _setSetting(self: SettingsAccessorBase, value: Any):
 			log.debug(f"Setting value for setting {setting} to {value}")
 			attribute = self._getSettingAttributeName(setting)
-			self.driver.setRemoteAttribute(attribute, self.driver._pickle(value))
+			self.driver.setRemoteAttribute(attribute, self.driver._encodeSettingValue(value))
 			if self.driver._attributeValueProcessor.isAttributeSupported(attribute):
 				self.driver._attributeValueProcessor.setValue(attribute, value)
 
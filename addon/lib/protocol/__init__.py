@@ -2,15 +2,16 @@
 # Copyright 2023 Leonard de Ruijter <alderuijter@gmail.com>
 # License: GNU General Public License version 2.0
 
-import inspect
 import pickle
-import sys
+import re
+import struct
+import threading
 import time
 import types
 from abc import abstractmethod
 from concurrent.futures import ThreadPoolExecutor
 from enum import Enum, IntEnum
-from fnmatch import fnmatch
+from fnmatch import translate
 from functools import partial, update_wrapper, wraps
 from typing import (
 	Any,
@@ -18,7 +19,9 @@ from typing import (
 	DefaultDict,
 	Dict,
 	Generic,
+	List,
 	Optional,
+	Tuple,
 	TypeVar,
 	Union,
 	cast,
@@ -35,6 +38,36 @@ from .speech import SpeechAttribute, SpeechCommand
 
 ATTRIBUTE_SEPARATOR = b"`"
 SETTING_ATTRIBUTE_PREFIX = b"setting_"
+#: NVDA's core runs on the main thread.
+_mainThread = threading.main_thread()
+#: Sentinel to distinguish absent attribute values from stored None values.
+_missing = object()
+#: The pickle protocol used on the wire.
+#: Protocol 5 would allow out of band buffers, but requires Python 3.8 on both ends
+#: whereas the minimum supported NVDA version still ships Python 3.7,
+#: and a message frame carries exactly one contiguous payload.
+PICKLE_PROTOCOL = 4
+#: The wire format of a message header: driver type, command, payload length.
+_messageHeader = struct.Struct("<BBH")
+MESSAGE_HEADER_SIZE = _messageHeader.size
+#: Flush coalesced writes once this many bytes are pending,
+#: matching the named pipe buffer size.
+WRITE_COALESCE_FLUSH_THRESHOLD = 0x10000
+_scalarIntStruct = struct.Struct("<q")
+_scalarFloatStruct = struct.Struct("<d")
+
+
+class ScalarValueTag(bytes, Enum):
+	"""Type tags for setting values with a known shape,
+	allowing them to skip the pickle machinery on the wire.
+	"""
+
+	NONE = b"n"
+	BOOL = b"b"
+	INT = b"i"
+	FLOAT = b"f"
+	STR = b"s"
+	PICKLED = b"p"
 
 
 class DriverType(IntEnum):
@@ -116,6 +149,8 @@ class AttributeHandler(HandlerDecoratorBase, Generic[AttributeHandlerT]):
 	def __init__(self, attribute: AttributeT, func: AttributeHandlerT):
 		super().__init__(func)
 		self._attribute = attribute
+		# Compile the fnmatch pattern once so matching incoming attributes is a single C level call.
+		self._attributeMatcher = re.compile(translate(attribute.decode("ASCII")).encode("ASCII")).match
 
 	def __call__(
 		self,
@@ -208,10 +243,44 @@ class CommandHandlerStore(HandlerRegistrar):
 
 
 class AttributeHandlerStore(HandlerRegistrar, Generic[AttributeHandlerT]):
+	_exactHandlers: Dict[AttributeT, AttributeHandlerT]
+	_wildcardHandlers: List[AttributeHandlerT]
+	#: Maps attributes to the wildcard handler they resolved to.
+	_resolveCache: Dict[AttributeT, AttributeHandlerT]
+
+	def __init__(self):
+		super().__init__()
+		self._exactHandlers = {}
+		self._wildcardHandlers = []
+		self._resolveCache = {}
+
+	def register(self, handler):
+		super().register(handler)
+		if handler._isCatchAll:
+			self._wildcardHandlers.append(handler)
+		else:
+			self._exactHandlers[handler._attribute] = handler
+		self._resolveCache.clear()
+
+	def unregister(self, handler):
+		if handler._isCatchAll:
+			if handler in self._wildcardHandlers:
+				self._wildcardHandlers.remove(handler)
+		else:
+			self._exactHandlers.pop(handler._attribute, None)
+		self._resolveCache.clear()
+		return super().unregister(handler)
+
 	def _getRawHandler(self, attribute: AttributeT) -> AttributeHandlerT:
-		handler = next((v for v in self.handlers if fnmatch(attribute, v._attribute)), None)
+		handler = self._exactHandlers.get(attribute)
+		if handler is not None:
+			return handler
+		handler = self._resolveCache.get(attribute)
 		if handler is None:
-			raise NotImplementedError(f"No attribute sender for attribute {attribute}")
+			handler = next((v for v in self._wildcardHandlers if v._attributeMatcher(attribute)), None)
+			if handler is None:
+				raise NotImplementedError(f"No attribute sender for attribute {attribute}")
+			self._resolveCache[attribute] = handler
 		return handler
 
 	def _getHandler(self, attribute: AttributeT) -> AttributeHandlerT:
@@ -235,17 +304,20 @@ class AttributeValueProcessor(AttributeHandlerStore[AttributeReceiverT]):
 	_valueTimes: DefaultDict[AttributeT, float]
 	_values: Dict[AttributeT, Any]
 	_pendingAttributeRequests: DefaultDict[AttributeT, bool]
+	_valueEvents: DefaultDict[AttributeT, threading.Event]
 
 	def __init__(self):
 		super().__init__()
 		self._values = {}
 		self._valueTimes = DefaultDict(float)
 		self._pendingAttributeRequests = DefaultDict(bool)
+		self._valueEvents = DefaultDict(threading.Event)
 
 	def clearCache(self):
 		self._values.clear()
 		self._valueTimes.clear()
 		self._pendingAttributeRequests.clear()
+		self._valueEvents.clear()
 
 	def setAttributeRequestPending(self, attribute: AttributeT, state: bool = True):
 		log.debug(f"Request pending for attribute {attribute!r} set to {state!r}")
@@ -257,6 +329,23 @@ class AttributeValueProcessor(AttributeHandlerStore[AttributeReceiverT]):
 	def hasNewValueSince(self, attribute: AttributeT, t: float) -> bool:
 		return t <= self._valueTimes[attribute]
 
+	def waitForNewValue(self, attribute: AttributeT, initialTime: float, timeout: float) -> bool:
+		"""Blocks until a value newer than initialTime arrives for the given attribute.
+		Waits on a per attribute event signalled from :meth:`setValue`,
+		so the waiting thread wakes up as soon as the value is stored.
+		"""
+		event = self._valueEvents[attribute]
+		deadline = time.monotonic() + timeout
+		while not self.hasNewValueSince(attribute, initialTime):
+			event.clear()
+			# Guard against a value arriving between the check and the clear.
+			if self.hasNewValueSince(attribute, initialTime):
+				break
+			remaining = deadline - time.monotonic()
+			if remaining <= 0.0 or not event.wait(remaining):
+				return False
+		return True
+
 	def _getDefaultValue(self, attribute: AttributeT) -> AttributeValueT:
 		handler = self._getRawHandler(attribute)
 		log.debug(
@@ -274,10 +363,14 @@ class AttributeValueProcessor(AttributeHandlerStore[AttributeReceiverT]):
 			handler.__self__._bgExecutor.submit(callback, attribute, value)
 
 	def getValue(self, attribute: AttributeT, fallBackToDefault: bool = False):
-		if fallBackToDefault and attribute not in self._values:
+		value = self._values.get(attribute, _missing)
+		if value is not _missing:
+			return value
+		if fallBackToDefault:
 			log.debug(f"No value for attribute {attribute!r} on {self!r}, falling back to default")
-			self._values[attribute] = self._getDefaultValue(attribute)
-		return self._values[attribute]
+			value = self._values[attribute] = self._getDefaultValue(attribute)
+			return value
+		raise KeyError(attribute)
 
 	def clearValue(self, attribute):
 		self._values.pop(attribute, None)
@@ -285,6 +378,7 @@ class AttributeValueProcessor(AttributeHandlerStore[AttributeReceiverT]):
 	def setValue(self, attribute: AttributeT, value):
 		self._values[attribute] = value
 		self._valueTimes[attribute] = time.perf_counter()
+		self._valueEvents[attribute].set()
 		self._invokeUpdateCallback(attribute, value)
 
 	def __call__(self, attribute: AttributeT, rawValue: bytes):
@@ -299,37 +393,67 @@ class AttributeValueProcessor(AttributeHandlerStore[AttributeReceiverT]):
 class RemoteProtocolHandler(AutoPropertyObject):
 	_dev: IoBase
 	driverType: DriverType
-	_receiveBuffer: bytes
+	#: driverType as a plain int, precomputed to keep enum coercion off the wire paths.
+	_driverTypeInt: int
+	_receiveBuffer: bytearray
 	_commandHandlerStore: CommandHandlerStore
 	_attributeSenderStore: AttributeSenderStore
 	_attributeValueProcessor: AttributeValueProcessor
 	timeout: float = 1.0
 	cachePropertiesByDefault = True
 	_bgExecutor: ThreadPoolExecutor
+	#: Whether messages are coalesced into a single device write per i/o thread wakeup.
+	coalesceWrites: bool = False
+	_pendingWrites: List[bytes]
+	_pendingWritesSize: int
+	_pendingWritesLock: threading.Lock
+	_flushScheduled: bool
+	#: Names of handler decorated members, computed once per class rather than per instance.
+	_handlerNames: Tuple[str, ...]
+
+	@classmethod
+	def _collectHandlerNames(cls) -> Tuple[str, ...]:
+		names = []
+		for klass in reversed(cls.__mro__):
+			for name, value in vars(klass).items():
+				if isinstance(value, HandlerDecoratorBase) and name not in names:
+					names.append(name)
+		return tuple(names)
+
+	def __init_subclass__(cls, **kwargs):
+		super().__init_subclass__(**kwargs)
+		cls._handlerNames = cls._collectHandlerNames()
 
 	def __new__(cls, *args, **kwargs):
 		self = super().__new__(cls, *args, **kwargs)
 		self._commandHandlerStore = CommandHandlerStore()
 		self._attributeSenderStore = AttributeSenderStore()
 		self._attributeValueProcessor = AttributeValueProcessor()
-		handlers = inspect.getmembers(cls, predicate=lambda o: isinstance(o, HandlerDecoratorBase))
-		for k, v in handlers:
-			if isinstance(v, CommandHandler):
-				self._commandHandlerStore.register(getattr(self, k))
-			elif isinstance(v, AttributeSender):
-				self._attributeSenderStore.register(getattr(self, k))
-			elif isinstance(v, AttributeReceiver):
-				self._attributeValueProcessor.register(getattr(self, k))
+		for name in cls._handlerNames:
+			handler = getattr(cls, name)
+			if isinstance(handler, CommandHandler):
+				self._commandHandlerStore.register(getattr(self, name))
+			elif isinstance(handler, AttributeSender):
+				self._attributeSenderStore.register(getattr(self, name))
+			elif isinstance(handler, AttributeReceiver):
+				self._attributeValueProcessor.register(getattr(self, name))
 		return self
 
 	def terminateIo(self):
+		if self.coalesceWrites:
+			self._flushWrites()
 		# Make sure the device gets closed.
 		self._dev.close()
 
 	def __init__(self):
 		super().__init__()
 		self._bgExecutor = ThreadPoolExecutor(4, thread_name_prefix=self.__class__.__name__)
-		self._receiveBuffer = b""
+		self._driverTypeInt = int(self.driverType)
+		self._receiveBuffer = bytearray()
+		self._pendingWrites = []
+		self._pendingWritesSize = 0
+		self._pendingWritesLock = threading.Lock()
+		self._flushScheduled = False
 
 	def terminate(self):
 		try:
@@ -345,37 +469,35 @@ class RemoteProtocolHandler(AutoPropertyObject):
 			self._bgExecutor.shutdown()
 
 	def _onReceive(self, message: bytes):
-		if self._receiveBuffer:
-			message = self._receiveBuffer + message
-			self._receiveBuffer = b""
-		if not message[0] == self.driverType:
-			raise RuntimeError(f"Unexpected payload: {message}")
-		command = cast(CommandT, message[1])
-		expectedLength = int.from_bytes(message[2:4], sys.byteorder)
-		payload = message[4:]
-		actualLength = len(payload)
-		remainder: Optional[bytes] = None
-		if expectedLength != actualLength:
-			log.debug(
-				f"Expected payload of length {expectedLength}, "
-				f"actual length of payload {payload!r} is {actualLength}"
-			)
-			if expectedLength > actualLength:
-				self._receiveBuffer = message
-				return
-			else:
-				remainder = payload[expectedLength:]
-				payload = payload[:expectedLength]
-
-		try:
-			self._bgExecutor.submit(self._commandHandlerStore, command, payload)
-		finally:
-			if remainder:
-				self._onReceive(remainder)
+		buf = self._receiveBuffer
+		buf.extend(message)
+		while len(buf) >= MESSAGE_HEADER_SIZE:
+			driverType, command, expectedLength = _messageHeader.unpack_from(buf)
+			if driverType != self._driverTypeInt:
+				buf.clear()
+				raise RuntimeError(f"Unexpected payload: {message}")
+			command = cast(CommandT, command)
+			end = MESSAGE_HEADER_SIZE + expectedLength
+			if len(buf) < end:
+				log.debug(
+					f"Expected payload of length {expectedLength}, "
+					f"{len(buf) - MESSAGE_HEADER_SIZE} bytes received, waiting for more data"
+				)
+				break
+			payload = bytes(memoryview(buf)[MESSAGE_HEADER_SIZE:end])
+			del buf[:end]
+			try:
+				self._bgExecutor.submit(self._commandHandlerStore, command, payload)
+			except Exception:
+				log.error(f"Error dispatching command {command!r}", exc_info=True)
 
 	@commandHandler(GenericCommand.ATTRIBUTE)
 	def _command_attribute(self, payload: bytes):
-		attribute, value = payload[1:].split(b"`", 1)
+		# Slice out attribute and value directly rather than copying the whole
+		# payload with split, as the value can be a large pickled blob.
+		separatorIndex = payload.index(ATTRIBUTE_SEPARATOR, 1)
+		attribute = payload[1:separatorIndex]
+		value = payload[separatorIndex + 1 :]
 		log.debug(f"Handling attribute {attribute!r} on {self!r}, value {value!r}")
 		if not value:
 			log.debug(f"No value sent for attribute {attribute!r} on {self!r}, direction outgoing")
@@ -392,21 +514,44 @@ class RemoteProtocolHandler(AutoPropertyObject):
 		raise NotImplementedError
 
 	def writeMessage(self, command: CommandT, payload: bytes = b""):
-		data = bytes(
-			(
-				self.driverType,
-				command,
-				*len(payload).to_bytes(length=2, byteorder=sys.byteorder, signed=False),
-				*payload,
-			)
-		)
-		self._dev.write(data)
+		data = _messageHeader.pack(self._driverTypeInt, int(command), len(payload))
+		if payload:
+			data += payload
+		if not self.coalesceWrites:
+			self._dev.write(data)
+			return
+		flushNow = scheduleFlush = False
+		with self._pendingWritesLock:
+			self._pendingWrites.append(data)
+			self._pendingWritesSize += len(data)
+			ioThread = self._dev._ioThreadRef()
+			if self._pendingWritesSize >= WRITE_COALESCE_FLUSH_THRESHOLD or not ioThread:
+				flushNow = True
+			elif not self._flushScheduled:
+				self._flushScheduled = scheduleFlush = True
+		if flushNow:
+			self._flushWrites()
+		elif scheduleFlush:
+			ioThread.queueAsApc(self._flushWrites)
+
+	def _flushWrites(self, _param: int = 0):
+		"""Writes all coalesced messages to the device in a single call.
+		Called as APC on the i/o thread, or directly by callers that can't tolerate latency.
+		"""
+		with self._pendingWritesLock:
+			pendingWrites = self._pendingWrites
+			data = pendingWrites[0] if len(pendingWrites) == 1 else b"".join(pendingWrites)
+			pendingWrites.clear()
+			self._pendingWritesSize = 0
+			self._flushScheduled = False
+		if data:
+			self._dev.write(data)
 
 	def setRemoteAttribute(self, attribute: AttributeT, value: bytes):
 		log.debug(f"Setting remote attribute {attribute!r} to raw value {value!r}")
 		return self.writeMessage(
 			GenericCommand.ATTRIBUTE,
-			ATTRIBUTE_SEPARATOR + attribute + ATTRIBUTE_SEPARATOR + value,
+			b"".join((ATTRIBUTE_SEPARATOR, attribute, ATTRIBUTE_SEPARATOR, value)),
 		)
 
 	def requestRemoteAttribute(self, attribute: AttributeT):
@@ -417,23 +562,27 @@ class RemoteProtocolHandler(AutoPropertyObject):
 		self._attributeValueProcessor.setAttributeRequestPending(attribute)
 		self.writeMessage(
 			GenericCommand.ATTRIBUTE,
-			ATTRIBUTE_SEPARATOR + attribute + ATTRIBUTE_SEPARATOR,
+			b"".join((ATTRIBUTE_SEPARATOR, attribute, ATTRIBUTE_SEPARATOR)),
 		)
+		if self.coalesceWrites:
+			# Requests are latency sensitive, as callers may block waiting for the response.
+			self._flushWrites()
 
 	def _safeWait(self, predicate: Callable[[], bool], timeout: Optional[float] = None):
 		if timeout is None:
 			timeout = self.timeout
 		log.debug(f"Waiting for {predicate!r} during {timeout} seconds")
-		while timeout > 0.0:
+		deadline = time.monotonic() + timeout
+		while True:
 			if predicate():
-				log.debug(f"Waiting for {predicate!r} succeeded, {timeout} seconds remaining")
+				log.debug(f"Waiting for {predicate!r} succeeded")
 				return True
-			curTime = time.perf_counter()
-			res: bool = self._dev.waitForRead(timeout=timeout)
-			if res is False:
+			remaining = deadline - time.monotonic()
+			if remaining <= 0.0:
+				break
+			if not self._dev.waitForRead(timeout=remaining):
 				log.debug(f"Waiting for read for {predicate!r} failed. Predicate may still be True")
 				break
-			timeout -= time.perf_counter() - curTime
 		return predicate()
 
 	def getRemoteAttribute(
@@ -457,11 +606,10 @@ class RemoteProtocolHandler(AutoPropertyObject):
 	):
 		if initialTime is None:
 			initialTime = 0.0
+		if timeout is None:
+			timeout = self.timeout
 		log.debug(f"Waiting for attribute {attribute!r}")
-		result = self._safeWait(
-			lambda: self._attributeValueProcessor.hasNewValueSince(attribute, initialTime),
-			timeout=timeout,
-		)
+		result = self._attributeValueProcessor.waitForNewValue(attribute, initialTime, timeout)
 		if result:
 			log.debug(f"Waiting for attribute {attribute} succeeded")
 		else:
@@ -469,9 +617,45 @@ class RemoteProtocolHandler(AutoPropertyObject):
 		return result
 
 	def _pickle(self, obj: Any):
-		return pickle.dumps(obj, protocol=4)
-
-	def _unpickle(self, payload: bytes) -> Any:
+		return pickle.dumps(obj, protocol=PICKLE_PROTOCOL)
+
+	def _encodeSettingValue(self, value: Any) -> bytes:
+		"""Encodes a setting value, using a one byte type tag for common scalar types.
+		Values of other types fall back to pickle.
+		"""
+		valueType = type(value)
+		if value is None:
+			return ScalarValueTag.NONE
+		elif valueType is bool:
+			return ScalarValueTag.BOOL + (b"\x01" if value else b"\x00")
+		elif valueType is int and -0x8000000000000000 <= value <= 0x7FFFFFFFFFFFFFFF:
+			return ScalarValueTag.INT + _scalarIntStruct.pack(value)
+		elif valueType is float:
+			return ScalarValueTag.FLOAT + _scalarFloatStruct.pack(value)
+		elif valueType is str:
+			return ScalarValueTag.STR + value.encode("UTF-8")
+		return ScalarValueTag.PICKLED + self._pickle(value)
+
+	def _decodeSettingValue(self, payload: bytes) -> Any:
+		"""Decodes a setting value encoded by :meth:`_encodeSettingValue`."""
+		tag = payload[:1]
+		if tag == ScalarValueTag.NONE:
+			return None
+		elif tag == ScalarValueTag.BOOL:
+			return payload[1] != 0
+		elif tag == ScalarValueTag.INT:
+			return _scalarIntStruct.unpack_from(payload, 1)[0]
+		elif tag == ScalarValueTag.FLOAT:
+			return _scalarFloatStruct.unpack_from(payload, 1)[0]
+		elif tag == ScalarValueTag.STR:
+			return payload[1:].decode("UTF-8")
+		elif tag == ScalarValueTag.PICKLED:
+			return self._unpickle(payload[1:])
+		raise ValueError(f"Unknown scalar value tag {tag!r}")
+
+	def _unpickle(self, payload: Union[bytes, memoryview]) -> Any:
+		# pickle.loads accepts any object supporting the buffer protocol,
+		# so callers can pass a memoryview into a receive buffer without copying.
 		res = pickle.loads(payload)
 		if isinstance(res, AutoPropertyObject):
 			res.invalidateCache()
@@ -489,8 +673,16 @@ class RemoteProtocolHandler(AutoPropertyObject):
 					exc_info=True,
 				)
 
-		queueHandler.queueFunction(queueHandler.eventQueue, wrapper, *args, **kwargs)
+		if threading.current_thread() is _mainThread:
+			# Already on the main thread, no need for a queue round trip.
+			wrapper(*args, **kwargs)
+		else:
+			queueHandler.queueFunction(queueHandler.eventQueue, wrapper, *args, **kwargs)
 
 	@abstractmethod
 	def _onReadError(self, error: int) -> bool:
 		return False
+
+
+# __init_subclass__ only runs for subclasses, handle the base class itself here.
+RemoteProtocolHandler._handlerNames = RemoteProtocolHandler._collectHandlerNames()